@@ -1,12 +1,18 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, send_from_directory
 from flask_cors import CORS
+from a2wsgi import WSGIMiddleware
+import hashlib
+import hmac
 import os
+import orjson
+import secrets
 import webbrowser
 from threading import Timer
 import time
-from functools import wraps
+from functools import lru_cache, wraps
 from logger_config import create_loggers, log_request, log_response, log_error, log_execution_time
-from validation import TerrainValidator, ObjectValidator, SafetyAnalyzer
+from validation import TerrainValidator, ObjectValidator, SafetyAnalyzer, warm_up
+from store import LunarStore, TerrainStore
 
 # Инициализация логгеров
 loggers = create_loggers()
@@ -19,19 +25,78 @@ spectrum_logger = loggers['spectrum']
 error_logger = loggers['error']
 
 app = Flask(__name__, static_url_path='')
-CORS(app)
+CORS(app, expose_headers=['X-Shape', 'X-Dtype'])
 
 # Конфигурация
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # Максимальный размер файла 16MB
+INDEX_MAX_AGE = 3600  # Время кэширования index.html браузером, секунд
+# Ключ подписи токенов проверки размещения; для нескольких процессов должен быть общим
+app.config['SECRET_KEY'] = os.environ.get('LUNA_SECRET_KEY') or secrets.token_hex(32)
+
+# ASGI-обертка для запуска под uvicorn: соединения и чтение тела запроса
+# обслуживает event loop, а синхронные обработчики Flask выполняются в пуле потоков
+asgi_app = WSGIMiddleware(app, workers=int(os.environ.get('LUNA_THREADS', 32)))
 
 # Инициализация валидаторов
 terrain_validator = TerrainValidator()
 object_validator = ObjectValidator()
 safety_analyzer = SafetyAnalyzer()
 
-# Структуры данных для хранения информации о базе
-lunar_objects = {}
-terrain_data = {}
+# Прогрев кэшей при старте процесса, чтобы первый запрос не ждал JIT-компиляции
+_warm_up_start = time.perf_counter()
+warm_up()
+main_logger.info(f"Caches warmed up in {time.perf_counter() - _warm_up_start:.3f} seconds")
+
+# Хранилища данных о базе: объекты и последние загруженные рельефы (LRU).
+# При запуске нескольких процессов (gunicorn --workers) LUNA_DATA_DIR задает
+# общий каталог с данными; без него данные хранятся в памяти процесса
+TERRAIN_CACHE_SIZE = 8
+DATA_DIR = os.environ.get('LUNA_DATA_DIR')
+lunar_objects = LunarStore(path=os.path.join(DATA_DIR, 'objects.jsonl') if DATA_DIR else None)
+terrain_store = TerrainStore(
+    max_size=TERRAIN_CACHE_SIZE,
+    path=os.path.join(DATA_DIR, 'terrain') if DATA_DIR else None
+)
+
+@lru_cache(maxsize=8192)
+def _terrain_check(terrain_id, x, y, object_type):
+    """Проверка рельефа для позиции; результат зависит только от рельефа,
+    а terrain_id уникален для каждой загрузки, поэтому кэш не сбрасывается"""
+    terrain = terrain_store.get(terrain_id)
+    if not terrain:
+        # Рельеф вытеснен из хранилища: исключение не кэшируется lru_cache
+        raise KeyError(terrain_id)
+    return terrain_validator.validate_placement({'x': x, 'y': y}, object_type, terrain)
+
+def check_terrain(terrain, position, object_type):
+    """Проверка рельефа с кэшированием по (terrain_id, x, y, type)"""
+    try:
+        return _terrain_check(terrain['terrain_id'], position['x'], position['y'], object_type)
+    except (KeyError, TypeError):
+        # Неполные или нехешируемые данные, а также рельеф, уже вытесненный
+        # из хранилища, проверяем без кэша по переданному рельефу
+        return terrain_validator.validate_placement(position, object_type, terrain)
+
+def placement_token(data, terrain_id, version):
+    """HMAC-токен успешной проверки размещения для данной версии набора объектов"""
+    message = orjson.dumps(
+        [terrain_id, data.get('type'), data.get('position'), data.get('size'), version],
+        option=orjson.OPT_SORT_KEYS
+    )
+    return hmac.new(app.config['SECRET_KEY'].encode(), message, hashlib.sha256).hexdigest()
+
+def add_with_token(data, token):
+    """Добавляет объект без повторной проверки, если токен из /api/validate-placement
+    действителен и объекты с момента проверки не менялись; иначе возвращает None"""
+    terrain = terrain_store.get(data.get('terrain_id'))
+    if not isinstance(token, str) or not terrain:
+        return None
+
+    version = lunar_objects.version
+    expected = placement_token(data, terrain['terrain_id'], version)
+    if not hmac.compare_digest(token.encode(), expected.encode()):
+        return None
+    return lunar_objects.add(data, expected_version=version)
 
 def open_browser():
     """Открывает браузер с приложением"""
@@ -41,15 +106,25 @@ def open_browser():
     except Exception as e:
         main_logger.error(f"Failed to open browser: {str(e)}")
 
+class JSONResponse(Response):
+    """Ответ API с уже сериализованным JSON-телом"""
+    default_mimetype = 'application/json'
+
+@lru_cache(maxsize=256)
+def _message_body(success, message):
+    """Тело ответа без данных; сообщения повторяются, поэтому сериализуются один раз"""
+    return orjson.dumps({'success': success, 'message': message})
+
 def create_response(success, message, data=None, status=200):
     """Создает стандартизированный ответ API"""
-    response = {
-        'success': success,
-        'message': message
-    }
-    if data is not None:
-        response['data'] = data
-    return jsonify(response), status
+    if data is None:
+        body = _message_body(success, message)
+    else:
+        body = orjson.dumps(
+            {'success': success, 'message': message, 'data': data},
+            option=orjson.OPT_SERIALIZE_NUMPY
+        )
+    return JSONResponse(body, status=status)
 
 def log_api(logger):
     """Декоратор для логирования API"""
@@ -87,12 +162,12 @@ def log_api(logger):
     return decorator
 
 @app.route('/')
-@log_api(main_logger)
 def root():
-    """Корневой маршрут"""
+    """Корневой маршрут (без log_api: статика не требует логирования запроса)"""
     try:
-        main_logger.info("Serving index.html")
-        return send_from_directory('static', 'index.html')
+        main_logger.debug("Serving index.html")
+        # ETag/Last-Modified и Cache-Control позволяют браузеру не загружать файл повторно
+        return send_from_directory('static', 'index.html', conditional=True, max_age=INDEX_MAX_AGE)
     except Exception as e:
         main_logger.error(f"Error serving index.html: {str(e)}")
         return create_response(False, "Failed to load application", status=500)
@@ -114,14 +189,34 @@ def upload_terrain():
     
     try:
         # Обработка и валидация данных о рельефе
-        global terrain_data
         terrain_data = terrain_validator.process_terrain_file(file)
-        terrain_logger.info("Terrain data processed successfully")
-        return create_response(True, 'Terrain data uploaded successfully', terrain_data)
+        terrain_id = terrain_store.add(terrain_data)
+        terrain_logger.info(f"Terrain data processed successfully (terrain_id: {terrain_id})")
+        # Серверные массивы (ключи с "_") в ответ не включаем
+        response_data = {k: v for k, v in terrain_data.items() if not k.startswith('_')}
+        return create_response(True, 'Terrain data uploaded successfully', response_data)
     except Exception as e:
         terrain_logger.error(f"Error processing terrain data: {str(e)}", exc_info=True)
         return create_response(False, 'Failed to process terrain data', status=500)
 
+@app.route('/api/terrain/<terrain_id>/raw', methods=['GET'])
+@log_api(terrain_logger)
+def get_terrain_raw(terrain_id):
+    """Карта высот в бинарном виде (строки подряд, форма в X-Shape)"""
+    data = terrain_store.get(terrain_id)
+    if not data:
+        return create_response(False, 'Terrain not found', status=404)
+
+    height_map = data['_height_map']
+    return Response(
+        height_map.tobytes(),
+        mimetype='application/octet-stream',
+        headers={
+            'X-Shape': ','.join(map(str, height_map.shape)),
+            'X-Dtype': height_map.dtype.name
+        }
+    )
+
 @app.route('/api/objects', methods=['POST'])
 @log_api(objects_logger)
 def add_object():
@@ -133,20 +228,24 @@ def add_object():
 
         objects_logger.info(f"Adding new object: {data}")
 
+        # Размещение уже проверено через /api/validate-placement
+        if isinstance(data, dict) and 'validation_token' in data:
+            object_id = add_with_token(data, data.pop('validation_token'))
+            if object_id is not None:
+                objects_logger.info(f"Validation token accepted for object {object_id}")
+                return create_response(True, 'Object added successfully', {'id': object_id})
+
         # Валидация объекта
         validation_result = object_validator.validate_object(data)
         if not validation_result['valid']:
             return create_response(False, validation_result['message'], status=400)
 
         # Проверка размещения
-        if not terrain_data:
+        terrain = terrain_store.get(data.get('terrain_id'))
+        if not terrain:
             return create_response(False, 'Terrain data not loaded', status=400)
 
-        placement_result = terrain_validator.validate_placement(
-            data['position'],
-            data['type'],
-            terrain_data
-        )
+        placement_result = check_terrain(terrain, data['position'], data['type'])
         if not placement_result['valid']:
             return create_response(False, placement_result['message'], status=400)
 
@@ -154,14 +253,13 @@ def add_object():
         safety_result = safety_analyzer.analyze_safety(
             data,
             lunar_objects,
-            terrain_data
+            terrain
         )
         if not safety_result['valid']:
             return create_response(False, safety_result['message'], status=400)
 
         # Сохранение объекта
-        object_id = len(lunar_objects) + 1
-        lunar_objects[object_id] = data
+        object_id = lunar_objects.add(data)
         
         return create_response(True, 'Object added successfully', {'id': object_id})
     except Exception as e:
@@ -179,21 +277,22 @@ def validate_placement():
 
         validation_logger.info(f"Validating placement for: {data}")
 
-        if not terrain_data:
+        terrain = terrain_store.get(data.get('terrain_id'))
+        if not terrain:
             return create_response(False, 'Terrain data not loaded', status=400)
 
+        # Версию фиксируем до проверки безопасности: токен действителен, только
+        # пока набор объектов не изменился
+        version = lunar_objects.version
+
         # Комплексная проверка размещения
         validation_results = {
             'object': object_validator.validate_object(data),
-            'terrain': terrain_validator.validate_placement(
-                data['position'],
-                data['type'],
-                terrain_data
-            ),
+            'terrain': check_terrain(terrain, data['position'], data['type']),
             'safety': safety_analyzer.analyze_safety(
                 data,
                 lunar_objects,
-                terrain_data
+                terrain
             )
         }
 
@@ -201,10 +300,15 @@ def validate_placement():
         is_valid = all(result['valid'] for result in validation_results.values())
         messages = [result['message'] for result in validation_results.values() if not result['valid']]
 
+        # Токен передается отдельным полем, рядом с результатами проверок
+        response_data = {'results': validation_results}
+        if is_valid:
+            response_data['validation_token'] = placement_token(data, terrain['terrain_id'], version)
+
         return create_response(
             is_valid,
             'Validation successful' if is_valid else '; '.join(messages),
-            validation_results
+            response_data
         )
     except Exception as e:
         validation_logger.error(f"Error validating placement: {str(e)}", exc_info=True)
@@ -247,7 +351,8 @@ if __name__ == '__main__':
     main_logger.info("Starting LUNA application")
     Timer(1, open_browser).start()
     try:
-        app.run(debug=True)
+        import uvicorn
+        uvicorn.run(asgi_app, host='127.0.0.1', port=5000)
     except Exception as e:
         error_logger.critical(f"Failed to start application: {str(e)}", exc_info=True)
         raise 
\ No newline at end of file
@@ -0,0 +1,20 @@
+# Конфигурация gunicorn: несколько процессов для CPU-нагрузки (декодирование
+# изображений, расчет уклонов), в каждом процессе асинхронный воркер uvicorn.
+# Запуск: gunicorn app:asgi_app
+import multiprocessing
+import os
+import secrets
+
+bind = os.environ.get('LUNA_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('LUNA_WORKERS', multiprocessing.cpu_count()))
+worker_class = 'uvicorn.workers.UvicornWorker'
+
+# Общие для всех процессов каталог с объектами и рельефами и ключ подписи токенов.
+# Логи пишутся только в stderr (собирается gunicorn): файлы logs/*.log с ротацией
+# нельзя безопасно вести из нескольких процессов
+raw_env = [
+    f"LUNA_DATA_DIR={os.environ.get('LUNA_DATA_DIR', 'data')}",
+    f"LUNA_SECRET_KEY={os.environ.get('LUNA_SECRET_KEY') or secrets.token_hex(32)}",
+    "LUNA_LOG_TO_FILES=0",
+]
+errorlog = '-'
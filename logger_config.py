@@ -1,40 +1,88 @@
+import atexit
 import logging
 import logging.handlers
 import os
+import queue
 from datetime import datetime
 
+import orjson
+
+# Запись логов в файлы; при запуске нескольких процессов (gunicorn) отключается:
+# RotatingFileHandler не поддерживает ротацию одного файла из разных процессов,
+# поэтому логи пишутся только в stderr, который собирает gunicorn
+LOG_TO_FILES = os.environ.get('LUNA_LOG_TO_FILES', '1') != '0'
+
 # Создаем директорию для логов, если она не существует
-if not os.path.exists('logs'):
+if LOG_TO_FILES and not os.path.exists('logs'):
     os.makedirs('logs')
 
+_formatter = logging.Formatter(
+    fmt='%(asctime)s - %(levelname)s - [%(name)s] - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+# Общая очередь логов: потоки обработки запросов только кладут записи в очередь,
+# запись в файлы и консоль выполняет фоновый поток QueueListener
+_log_queue = queue.Queue(-1)
+_configured_loggers = set()
+_file_handlers = {}  # имя логгера -> обработчик его файла
+_listener = None
+_listener_handlers = ()
+
+# Обработчик для консоли (общий для всех логгеров)
+_console_handler = logging.StreamHandler()
+_console_handler.setFormatter(_formatter)
+
 # Настройка основного логгера
 def setup_logger(name, log_file, level=logging.INFO):
-    formatter = logging.Formatter(
-        fmt='%(asctime)s - %(levelname)s - [%(name)s] - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
 
-    # Обработчик для файла
-    file_handler = logging.handlers.RotatingFileHandler(
-        log_file,
-        maxBytes=10485760,  # 10MB
-        backupCount=5,
-        encoding='utf-8'
-    )
-    file_handler.setFormatter(formatter)
+    # Повторный вызов (например, при повторном импорте модуля) не добавляет обработчики
+    if name in _configured_loggers:
+        return logger
+    _configured_loggers.add(name)
 
-    # Обработчик для консоли
-    console_handler = logging.StreamHandler()
-    console_handler.setFormatter(formatter)
+    # Обработчик для файла (только записи этого логгера)
+    if LOG_TO_FILES:
+        file_handler = logging.handlers.RotatingFileHandler(
+            log_file,
+            maxBytes=10485760,  # 10MB
+            backupCount=5,
+            encoding='utf-8'
+        )
+        file_handler.setFormatter(_formatter)
+        file_handler.addFilter(logging.Filter(name))
+        _file_handlers[name] = file_handler
 
     # Настройка логгера
-    logger = logging.getLogger(name)
-    logger.setLevel(level)
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    logger.addHandler(logging.handlers.QueueHandler(_log_queue))
 
     return logger
 
+def start_log_listener():
+    """Запускает фоновый поток, записывающий логи из очереди"""
+    global _listener, _listener_handlers
+    handlers = (*_file_handlers.values(), _console_handler)
+    if _listener is not None:
+        if handlers == _listener_handlers:
+            return
+        _listener.stop()
+    _listener = logging.handlers.QueueListener(
+        _log_queue, *handlers, respect_handler_level=True
+    )
+    _listener_handlers = handlers
+    _listener.start()
+
+def stop_log_listener():
+    """Останавливает фоновый поток, дописав оставшиеся в очереди записи"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+atexit.register(stop_log_listener)
+
 # Создаем различные логгеры для разных компонентов
 def create_loggers():
     logs = {
@@ -46,25 +94,41 @@ def create_loggers():
         'spectrum': setup_logger('spectrum', 'logs/spectrum.log'),
         'error': setup_logger('error', 'logs/error.log', level=logging.ERROR)
     }
+    start_log_listener()
     return logs
 
+def _to_json(data):
+    """Сериализация данных для записи в лог"""
+    return orjson.dumps(data, default=str).decode()
+
+# Заголовки запроса, которые пишутся в лог в режиме DEBUG
+# (Authorization, Cookie и прочие в лог не попадают)
+LOGGED_HEADERS = ('Content-Type', 'Content-Length', 'User-Agent')
+
 # Функция для логирования запросов к API
 def log_request(logger, request, include_body=False):
-    log_data = {
-        'method': request.method,
-        'url': request.url,
-        'headers': dict(request.headers),
-        'remote_addr': request.remote_addr,
-    }
-    
+    if not logger.isEnabledFor(logging.INFO):
+        return
+
+    logger.info("Request: method=%s url=%s remote=%s", request.method, request.url, request.remote_addr)
+
+    # Заголовки и тело запроса пишем только в режиме DEBUG
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+
+    headers = request.headers
+    log_data = {'headers': {k: headers[k] for k in LOGGED_HEADERS if k in headers}}
     if include_body and request.is_json:
-        log_data['body'] = request.get_json()
-    
-    logger.info(f"Request: {log_data}")
+        log_data['body'] = request.get_json(cache=True, silent=True)
+
+    logger.debug("Request details: %s", _to_json(log_data))
 
 # Функция для логирования ответов API
 def log_response(logger, response, include_body=False):
     """Логирование ответов API"""
+    if not logger.isEnabledFor(logging.INFO):
+        return
+
     # Если response это кортеж (response, status_code)
     if isinstance(response, tuple):
         response_obj, status_code = response
@@ -72,15 +136,20 @@ def log_response(logger, response, include_body=False):
         response_obj = response
         status_code = response.status_code
 
+    logger.info("Response: status=%s", status_code)
+
+    # Заголовки и тело ответа пишем только в режиме DEBUG, без повторного разбора JSON
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+
     log_data = {
-        'status': status_code,
         'headers': dict(response_obj.headers) if hasattr(response_obj, 'headers') else {}
     }
     
     if include_body:
         try:
-            if hasattr(response_obj, 'get_json'):
-                log_data['body'] = response_obj.get_json()
+            if getattr(response_obj, 'is_json', False):
+                log_data['body'] = response_obj.get_data(as_text=True)
             elif isinstance(response_obj, dict):
                 log_data['body'] = response_obj
             else:
@@ -88,7 +157,7 @@ def log_response(logger, response, include_body=False):
         except:
             log_data['body'] = 'Non-JSON response'
     
-    logger.info(f"Response: {log_data}")
+    logger.debug("Response details: %s", _to_json(log_data))
 
 # Функция для логирования ошибок
 def log_error(error_logger, error, context=None):
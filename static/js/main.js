@@ -95,6 +95,24 @@ function initializeEventListeners() {
     });
 }
 
+// Загрузка карты высот рельефа в виде массива строк
+async function fetchHeightMap(terrainId) {
+    const response = await fetch(`${API_URL}/terrain/${terrainId}/raw`);
+    if (!response.ok) {
+        throw new Error('Не удалось получить карту высот');
+    }
+
+    const [height, width] = response.headers.get('X-Shape').split(',').map(Number);
+    const ArrayType = response.headers.get('X-Dtype') === 'float32' ? Float32Array : Uint8Array;
+    const values = new ArrayType(await response.arrayBuffer());
+
+    const heightMap = [];
+    for (let y = 0; y < height; y++) {
+        heightMap.push(Array.from(values.subarray(y * width, (y + 1) * width)));
+    }
+    return heightMap;
+}
+
 // Обработчики событий
 async function handleTerrainUpload() {
     const input = document.createElement('input');
@@ -126,6 +144,9 @@ async function handleTerrainUpload() {
                 throw new Error(data.message || 'Ошибка загрузки рельефа');
             }
 
+            // Карта высот передается отдельно в бинарном виде
+            data.data.height_map = await fetchHeightMap(data.data.terrain_id);
+
             // Обновляем карту
             lunarMap.setTerrain(data.data);
             
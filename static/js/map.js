@@ -188,7 +188,8 @@ class LunarMap {
                 body: JSON.stringify({
                     type: this.placementPreview.type,
                     size: this.placementPreview.size,
-                    position: position
+                    position: position,
+                    terrain_id: this.terrain ? this.terrain.terrain_id : undefined
                 })
             });
 
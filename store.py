@@ -0,0 +1,385 @@
+import glob
+import os
+import re
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+from collections.abc import Mapping
+from contextlib import contextmanager
+from typing import Dict
+
+import numpy as np
+import orjson
+from scipy.spatial import cKDTree
+
+
+def position_vector(position) -> np.ndarray:
+    """Координаты позиции (словарь x/y/z или последовательность) в виде вектора float32"""
+    if isinstance(position, dict):
+        return np.array([position['x'], position['y'], position.get('z', 0)], dtype=np.float32)
+    vector = np.zeros(3, dtype=np.float32)
+    vector[:len(position)] = position
+    return vector
+
+
+@contextmanager
+def _file_lock(file):
+    """Эксклюзивная блокировка файла, общая для всех процессов"""
+    import fcntl  # только POSIX; нужен лишь для общего файлового хранилища
+    fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
+def _write_atomic(path, write):
+    """Запись через временный файл: другие процессы не увидят файл частично"""
+    # Уникальное имя для каждого вызова: загрузки обрабатываются параллельно
+    # и в разных процессах, и в потоках одного процесса
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            write(file)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+class ObjectSnapshot:
+    """Согласованный срез объектов базы: представления массивов хранилища без копирования"""
+
+    def __init__(self, ids, positions, type_codes, type_names, tree=None):
+        self.ids = ids
+        self.positions = positions
+        self.type_codes = type_codes
+        self.type_names = type_names
+        self.tree = tree
+
+    def per_type(self, values: Dict[str, float], default: float = 0.0, indices=None) -> np.ndarray:
+        """Значение из словаря по типу для каждого объекта или для объектов с индексами indices
+        (например, радиус зоны)"""
+        table = np.array([values.get(name, default) for name in self.type_names], dtype=np.float32)
+        type_codes = self.type_codes if indices is None else self.type_codes[indices]
+        return table[type_codes]
+
+    def distances(self, position, indices=None) -> np.ndarray:
+        """Расстояния от позиции до всех объектов (или до объектов с индексами indices)"""
+        positions = self.positions if indices is None else self.positions[indices]
+        return np.linalg.norm(positions - position_vector(position), axis=1)
+
+    def neighbors(self, position, radius: float) -> np.ndarray:
+        """Индексы объектов не дальше radius от позиции, в порядке добавления"""
+        if self.tree is None:
+            return np.flatnonzero(self.distances(position) <= radius)
+
+        # Дерево может покрывать только первые tree.n объектов: добавленные
+        # после его построения проверяем линейно
+        indexed = self.tree.n
+        indices = self.tree.query_ball_point(position_vector(position), r=radius, return_sorted=True)
+        tail = np.linalg.norm(self.positions[indexed:] - position_vector(position), axis=1)
+        return np.concatenate((
+            np.asarray(indices, dtype=np.intp),
+            indexed + np.flatnonzero(tail <= radius)
+        ))
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class LunarStore(Mapping):
+    """Потокобезопасное хранилище объектов базы.
+
+    Позиции, идентификаторы и коды типов хранятся в параллельных массивах (SoA),
+    которые растут блоками; исходные данные объектов доступны как словарь по id.
+    Если задан path, объекты дополнительно пишутся в журнал (JSON Lines), общий
+    для нескольких процессов: каждый процесс дочитывает чужие записи перед
+    обращением к данным, а id выдаются под файловой блокировкой.
+    """
+
+    CHUNK_SIZE = 1024
+    # KD-дерево перестраивается, когда непроиндексированных объектов становится
+    # больше CHUNK_SIZE и 1/TREE_REBUILD_RATIO от уже проиндексированных
+    TREE_REBUILD_RATIO = 8
+
+    def __init__(self, objects: Dict[int, Dict] = None, path: str = None):
+        self._lock = threading.RLock()
+        self._raw = {}
+        self._size = 0
+        self._last_id = 0
+        self._ids = np.empty(0, dtype=np.int64)
+        self._positions = np.empty((0, 3), dtype=np.float32)
+        self._type_codes = np.empty(0, dtype=np.intp)
+        self._type_names = []
+        self._type_index = {}
+        self._tree = None  # KD-дерево по первым tree.n позициям
+        self._tree_building = False
+
+        for object_id, object_data in (objects or {}).items():
+            self._append(object_id, object_data)
+
+        self._path = path
+        self._offset = 0  # прочитанная часть журнала, байт
+        if path is not None:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self._sync()
+
+    @property
+    def version(self) -> int:
+        """Версия набора объектов: меняется при каждом добавлении"""
+        return len(self)
+
+    def add(self, object_data: Dict, expected_version: int = None) -> int:
+        """Добавление объекта; возвращает присвоенный id.
+
+        Если указан expected_version, объект добавляется только при неизменной
+        версии (иначе возвращается None) — проверка и запись выполняются атомарно.
+        """
+        with self._lock:
+            if self._path is None:
+                if expected_version is not None and self._size != expected_version:
+                    return None
+                object_id = self._last_id + 1
+                self._append(object_id, object_data)
+                return object_id
+
+            # Проверяем данные до записи, чтобы не оставить в журнале некорректную запись
+            position_vector(object_data['position'])
+            with open(self._path, 'ab') as journal, _file_lock(journal):
+                self._sync()
+                # Под блокировкой никто не пишет, поэтому недописанный хвост после
+                # последней полной строки остался от прерванной записи: отрезаем его,
+                # чтобы новая запись не склеилась с ним
+                journal.seek(0, os.SEEK_END)
+                if journal.tell() > self._offset:
+                    journal.truncate(self._offset)
+                if expected_version is not None and self._size != expected_version:
+                    return None
+                object_id = self._last_id + 1
+                record = orjson.dumps({'id': object_id, 'data': object_data}) + b'\n'
+                journal.write(record)
+                journal.flush()
+                self._append(object_id, object_data)
+                self._offset += len(record)
+            return object_id
+
+    def snapshot(self) -> ObjectSnapshot:
+        """Текущие объекты; последующие добавления на срез не влияют"""
+        with self._lock:
+            self._sync()
+            n = self._size
+            tree = self._tree
+            indexed = 0 if tree is None else tree.n
+            rebuild = (not self._tree_building and
+                       n - indexed > max(self.CHUNK_SIZE, indexed // self.TREE_REBUILD_RATIO))
+            if rebuild:
+                self._tree_building = True
+            snapshot = ObjectSnapshot(
+                self._ids[:n],
+                self._positions[:n],
+                self._type_codes[:n],
+                list(self._type_names),
+                tree
+            )
+
+        if rebuild:
+            snapshot.tree = self._build_tree(snapshot.positions)
+        return snapshot
+
+    def _build_tree(self, positions):
+        """Строит KD-дерево вне блокировки и подменяет им текущее"""
+        try:
+            # Строки [:n] массива позиций не меняются, поэтому строить дерево
+            # можно параллельно с добавлением объектов
+            tree = cKDTree(positions)
+            with self._lock:
+                if self._tree is None or self._tree.n < tree.n:
+                    self._tree = tree
+            return tree
+        finally:
+            with self._lock:
+                self._tree_building = False
+
+    def _sync(self):
+        """Дочитывает записи журнала, добавленные другими процессами"""
+        if self._path is None:
+            return
+        try:
+            if os.path.getsize(self._path) == self._offset:
+                return
+        except FileNotFoundError:
+            return
+
+        with open(self._path, 'rb') as journal:
+            journal.seek(self._offset)
+            for line in journal:
+                if not line.endswith(b'\n'):
+                    break  # запись еще дописывается
+                self._offset += len(line)
+                try:
+                    record = orjson.loads(line)
+                    self._append(record['id'], record['data'])
+                except (orjson.JSONDecodeError, KeyError, TypeError, ValueError):
+                    continue  # поврежденную запись пропускаем
+
+    def _append(self, object_id: int, object_data: Dict):
+        position = position_vector(object_data['position'])
+        object_type = object_data['type']
+
+        code = self._type_index.get(object_type)
+        if code is None:
+            code = self._type_index[object_type] = len(self._type_names)
+            self._type_names.append(object_type)
+
+        if self._size == len(self._ids):
+            self._grow()
+
+        # Запись идет в строки за пределами выданных срезов, поэтому
+        # ранее полученные ObjectSnapshot остаются неизменными
+        i = self._size
+        self._ids[i] = object_id
+        self._positions[i] = position
+        self._type_codes[i] = code
+        self._raw[object_id] = object_data
+        self._size += 1
+        self._last_id = max(self._last_id, object_id)
+
+    def _grow(self):
+        capacity = max(self.CHUNK_SIZE, 2 * len(self._ids))
+        n = self._size
+
+        ids = np.empty(capacity, dtype=self._ids.dtype)
+        ids[:n] = self._ids[:n]
+        positions = np.empty((capacity, 3), dtype=self._positions.dtype)
+        positions[:n] = self._positions[:n]
+        type_codes = np.empty(capacity, dtype=self._type_codes.dtype)
+        type_codes[:n] = self._type_codes[:n]
+
+        self._ids, self._positions, self._type_codes = ids, positions, type_codes
+
+    def __getitem__(self, object_id):
+        with self._lock:
+            self._sync()
+            return self._raw[object_id]
+
+    def __iter__(self):
+        with self._lock:
+            self._sync()
+            return iter(list(self._raw))
+
+    def __len__(self):
+        with self._lock:
+            self._sync()
+            return self._size
+
+
+class TerrainStore:
+    """Потокобезопасный LRU-кэш загруженных рельефов по terrain_id.
+
+    Если задан path, рельефы сохраняются в каталог (массивы в .npy, метаданные
+    в .json) и доступны всем процессам: массивы загружаются через mmap, так что
+    процессы разделяют одни страницы памяти. На диске хранятся max_size
+    последних рельефов.
+    """
+
+    ARRAY_KEYS = ('_height_map', '_slope_deg')
+    _ID_PATTERN = re.compile(r'[0-9a-f]{32}')
+
+    def __init__(self, max_size: int = 8, path: str = None):
+        self.max_size = max_size
+        self._lock = threading.RLock()
+        self._terrains = OrderedDict()
+        self._current_id = None
+        self._path = path
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def add(self, terrain_data: Dict) -> str:
+        """Сохраняет рельеф как текущий и возвращает его terrain_id"""
+        terrain_id = uuid.uuid4().hex
+        terrain_data['terrain_id'] = terrain_id
+        if self._path is not None:
+            self._save(terrain_id, terrain_data)
+        with self._lock:
+            self._remember(terrain_id, terrain_data)
+            self._current_id = terrain_id
+        return terrain_id
+
+    def get(self, terrain_id: str = None):
+        """Рельеф по terrain_id (по умолчанию последний загруженный) или None"""
+        with self._lock:
+            if terrain_id is None:
+                terrain_id = self._read_current() if self._path is not None else self._current_id
+            terrain_data = self._terrains.get(terrain_id)
+            if terrain_data is not None:
+                self._terrains.move_to_end(terrain_id)
+            elif self._path is not None and self._valid_id(terrain_id):
+                terrain_data = self._load(terrain_id)
+                if terrain_data is not None:
+                    self._remember(terrain_id, terrain_data)
+            return terrain_data
+
+    def _remember(self, terrain_id, terrain_data):
+        self._terrains[terrain_id] = terrain_data
+        while len(self._terrains) > self.max_size:
+            self._terrains.popitem(last=False)
+
+    def _valid_id(self, terrain_id):
+        # terrain_id приходит от клиента и используется в именах файлов
+        return isinstance(terrain_id, str) and self._ID_PATTERN.fullmatch(terrain_id) is not None
+
+    def _file(self, name):
+        return os.path.join(self._path, name)
+
+    def _save(self, terrain_id, terrain_data):
+        for key in self.ARRAY_KEYS:
+            if key in terrain_data:
+                _write_atomic(self._file(f'{terrain_id}{key}.npy'),
+                              lambda file, array=terrain_data[key]: np.save(file, array))
+
+        # Метаданные пишутся последними: по ним другие процессы считают рельеф сохраненным
+        meta = {k: v for k, v in terrain_data.items() if not k.startswith('_')}
+        _write_atomic(self._file(f'{terrain_id}.json'), lambda file: file.write(orjson.dumps(meta)))
+        _write_atomic(self._file('current'), lambda file: file.write(terrain_id.encode()))
+        self._prune()
+
+    def _load(self, terrain_id):
+        try:
+            with open(self._file(f'{terrain_id}.json'), 'rb') as file:
+                terrain_data = orjson.loads(file.read())
+            for key in self.ARRAY_KEYS:
+                array_path = self._file(f'{terrain_id}{key}.npy')
+                if os.path.exists(array_path):
+                    terrain_data[key] = np.load(array_path, mmap_mode='r')
+            return terrain_data
+        except FileNotFoundError:
+            return None
+
+    def _read_current(self):
+        try:
+            with open(self._file('current'), 'rb') as file:
+                return file.read().decode()
+        except FileNotFoundError:
+            return None
+
+    def _prune(self):
+        """Удаляет с диска рельефы сверх max_size последних"""
+        def mtime(path):
+            try:
+                return os.path.getmtime(path)
+            except FileNotFoundError:
+                return 0.0
+
+        meta_files = sorted(glob.glob(self._file('*.json')), key=mtime)
+        for meta_file in meta_files[:-self.max_size]:
+            terrain_id = os.path.splitext(os.path.basename(meta_file))[0]
+            for path in glob.glob(self._file(f'{terrain_id}*')):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass  # уже удален другим процессом
@@ -1,14 +1,61 @@
+import fastjsonschema
 import numpy as np
 from typing import Dict, List, Tuple, Any
 import math
 from PIL import Image
 import io
+import os
+from store import LunarStore, ObjectSnapshot, position_vector
+
+try:
+    from numba import njit
+except ImportError:  # numba не установлен: уклоны считаются средствами NumPy
+    njit = None
+
+_DEG_PER_RAD = np.float32(180.0 / np.pi)
+
+
+def _slope_map_kernel(height_map: np.ndarray) -> np.ndarray:
+    """Карта уклонов в градусах за один проход по карте высот: те же разности,
+    что у np.gradient (центральные внутри, односторонние на краях).
+    Карта высот читается в исходном типе (uint8) без копии во float"""
+    h, w = height_map.shape
+    out = np.empty((h, w), dtype=np.float32)
+    for y in range(h):
+        y0 = max(y - 1, 0)
+        y1 = min(y + 1, h - 1)
+        for x in range(w):
+            x0 = max(x - 1, 0)
+            x1 = min(x + 1, w - 1)
+            gx = (float(height_map[y, x1]) - float(height_map[y, x0])) / max(x1 - x0, 1)
+            gy = (float(height_map[y1, x]) - float(height_map[y0, x])) / max(y1 - y0, 1)
+            out[y, x] = math.atan(math.sqrt(gx * gx + gy * gy)) * _DEG_PER_RAD
+    return out
+
+
+if njit is not None:
+    _slope_map_kernel = njit(cache=True, fastmath=True)(_slope_map_kernel)
+else:
+    _slope_map_kernel = None
+
+
+def object_snapshot(existing_objects) -> ObjectSnapshot:
+    """Срез объектов для векторных проверок (из LunarStore или словаря объектов)"""
+    if isinstance(existing_objects, ObjectSnapshot):
+        return existing_objects
+    if not isinstance(existing_objects, LunarStore):
+        existing_objects = LunarStore(existing_objects)
+    return existing_objects.snapshot()
+
 
 class TerrainValidator:
     """Валидатор данных о рельефе"""
     
     SUPPORTED_FORMATS = ['.jpg', '.jpeg', '.png', '.tiff']
+    _EXT_SET = frozenset(SUPPORTED_FORMATS)
     MAX_FILE_SIZE = 16 * 1024 * 1024  # 16MB
+    MAX_PIXELS = 8192 * 8192  # защита от "бомб" декомпрессии
+    MAX_DIMENSION = 2048  # карты большего размера уменьшаются при загрузке
     
     def __init__(self):
         self.max_slope = {
@@ -34,20 +81,26 @@ class TerrainValidator:
             if not self._validate_file_format(file.filename):
                 raise ValueError(f"Неподдерживаемый формат файла. Поддерживаемые форматы: {', '.join(self.SUPPORTED_FORMATS)}")
             
-            # Чтение и валидация изображения
-            image_data = file.read()
-            if len(image_data) > self.MAX_FILE_SIZE:
+            # Проверка размера без чтения файла в память: Werkzeug уже
+            # сохранил загрузку во временный файл, достаточно перейти в конец
+            stream = file.stream
+            stream.seek(0, os.SEEK_END)
+            if stream.tell() > self.MAX_FILE_SIZE:
                 raise ValueError(f"Размер файла превышает максимально допустимый ({self.MAX_FILE_SIZE / 1024 / 1024}MB)")
+            stream.seek(0)
             
-            # Преобразование в массив высот
-            height_map = self._process_image(image_data)
+            # Преобразование в массив высот (PIL декодирует прямо из потока)
+            height_map = self._process_image(stream)
             
             # Базовая валидация данных
             if not self._validate_height_map(height_map):
                 raise ValueError("Некорректные данные о рельефе")
             
             return {
-                'height_map': height_map.tolist(),
+                # Массивы с префиксом "_" используются только на сервере и не
+                # сериализуются в JSON-ответ
+                '_height_map': height_map,
+                '_slope_deg': self._slope_map(height_map),
                 'dimensions': {
                     'width': height_map.shape[1],
                     'height': height_map.shape[0]
@@ -65,18 +118,30 @@ class TerrainValidator:
     
     def _validate_file_format(self, filename):
         """Проверка формата файла"""
-        return any(filename.lower().endswith(fmt) for fmt in self.SUPPORTED_FORMATS)
+        return os.path.splitext(filename or '')[1].lower() in self._EXT_SET
     
-    def _process_image(self, image_data):
-        """Преобразование изображения в карту высот"""
+    def _process_image(self, image_file):
+        """Преобразование изображения (файловый объект) в карту высот"""
         try:
-            # Открываем изображение
-            img = Image.open(io.BytesIO(image_data))
+            # Открываем изображение (читается только заголовок)
+            img = Image.open(image_file)
+            width, height = img.size
+            if width * height > self.MAX_PIXELS:
+                raise ValueError(f"Слишком большое изображение ({width}x{height})")
+            
+            # Для JPEG декодер сразу выдает оттенки серого в уменьшенном масштабе;
+            # для остальных форматов draft ничего не делает
+            max_size = (self.MAX_DIMENSION, self.MAX_DIMENSION)
+            img.draft('L', max_size)
             
             # Преобразуем в оттенки серого
             if img.mode != 'L':
                 img = img.convert('L')
             
+            # Уменьшаем карту, если она все еще превышает допустимый размер
+            if max(img.size) > self.MAX_DIMENSION:
+                img.thumbnail(max_size)
+            
             # Преобразуем в numpy массив
             height_map = np.array(img)
             
@@ -104,15 +169,15 @@ class TerrainValidator:
     def validate_placement(self, position, object_type, terrain_data):
         """Проверка возможности размещения объекта"""
         try:
-            height_map = np.array(terrain_data['height_map'])
+            slope_map = self._get_slope_map(terrain_data)
             x, y = int(position['x']), int(position['y'])
             
             # Проверка границ
-            if not (0 <= x < height_map.shape[1] and 0 <= y < height_map.shape[0]):
+            if not (0 <= x < slope_map.shape[1] and 0 <= y < slope_map.shape[0]):
                 return {'valid': False, 'message': 'Позиция находится за пределами карты'}
             
             # Проверка уклона
-            slope = self._calculate_slope(height_map, x, y)
+            slope = self._calculate_slope(slope_map, x, y)
             max_allowed_slope = self._get_max_allowed_slope(object_type)
             
             if slope > max_allowed_slope:
@@ -123,22 +188,38 @@ class TerrainValidator:
         except Exception as e:
             return {'valid': False, 'message': f'Ошибка при проверке размещения: {str(e)}'}
     
-    def _calculate_slope(self, height_map, x, y, window_size=3):
-        """Расчет уклона местности"""
-        # Получаем окрестность точки
-        x_start = max(0, x - window_size // 2)
-        x_end = min(height_map.shape[1], x + window_size // 2 + 1)
-        y_start = max(0, y - window_size // 2)
-        y_end = min(height_map.shape[0], y + window_size // 2 + 1)
-        
-        region = height_map[y_start:y_end, x_start:x_end]
+    def _get_slope_map(self, terrain_data):
+        """Карта уклонов рельефа; для данных без серверных массивов (например,
+        импортированных из JSON) строится один раз и сохраняется в terrain_data"""
+        slope_map = terrain_data.get('_slope_deg')
+        if slope_map is None:
+            height_map = terrain_data.get('_height_map')
+            if height_map is None:
+                height_map = np.asarray(terrain_data['height_map'], dtype=np.float32)
+                terrain_data['_height_map'] = height_map
+            slope_map = terrain_data['_slope_deg'] = self._slope_map(height_map)
+        return slope_map
+    
+    def _slope_map(self, height_map):
+        """Расчет карты уклонов (в градусах) для всей карты высот"""
+        if _slope_map_kernel is not None:
+            return _slope_map_kernel(np.ascontiguousarray(height_map))
         
-        # Расчет градиентов
-        gy, gx = np.gradient(region)
+        # Расчет во float32 с переиспользованием массивов градиентов
+        gy, gx = np.gradient(height_map.astype(np.float32, copy=False))
+        slope = np.hypot(gx, gy, out=gx)
+        np.arctan(slope, out=slope)
+        slope *= _DEG_PER_RAD
+        return slope
+    
+    def _calculate_slope(self, slope_map, x, y, window_size=3):
+        """Расчет уклона местности по заранее рассчитанной карте уклонов"""
+        # Получаем окрестность точки
+        half = window_size // 2
+        region = slope_map[max(0, y - half):y + half + 1, max(0, x - half):x + half + 1]
         
-        # Расчет максимального уклона в градусах
-        slope = np.arctan(np.sqrt(gx**2 + gy**2)) * 180 / np.pi
-        return float(np.max(slope))
+        # Максимальный уклон в окрестности
+        return float(region.max())
     
     def _get_max_allowed_slope(self, object_type):
         """Получение максимально допустимого уклона для типа объекта"""
@@ -175,7 +256,34 @@ class TerrainValidator:
         return []
 
 
+# Схема данных объекта компилируется один раз при загрузке модуля
+OBJECT_SCHEMA = {
+    'type': 'object',
+    'required': ['type', 'position', 'size'],
+    'properties': {
+        'type': {'type': 'string'},
+        'position': {
+            'type': 'object',
+            'required': ['x', 'y'],
+            'properties': {
+                'x': {'type': 'number'},
+                'y': {'type': 'number'}
+            }
+        },
+        'size': {'type': 'number', 'exclusiveMinimum': 0}
+    }
+}
+_validate_object_schema = fastjsonschema.compile(OBJECT_SCHEMA)
+
+
 class ObjectValidator:
+    # Сообщения об ошибках по полям схемы объекта
+    FIELD_ERRORS = {
+        'type': 'Тип объекта должен быть строкой',
+        'position': 'Позиция должна содержать координаты x и y',
+        'size': 'Размер должен быть положительным числом'
+    }
+
     def __init__(self):
         self.min_distances = {
             'residential': {
@@ -204,62 +312,59 @@ class ObjectValidator:
     def validate_object(self, object_data: Dict) -> Dict:
         """Валидация данных объекта"""
         try:
-            required_fields = ['type', 'position', 'size']
-            for field in required_fields:
-                if field not in object_data:
-                    return {
-                        'valid': False,
-                        'message': f'Отсутствует обязательное поле: {field}'
-                    }
-
-            # Проверка типа объекта
-            if not isinstance(object_data['type'], str):
-                return {
-                    'valid': False,
-                    'message': 'Тип объекта должен быть строкой'
-                }
-
-            # Проверка позиции
-            position = object_data['position']
-            if not isinstance(position, dict) or 'x' not in position or 'y' not in position:
-                return {
-                    'valid': False,
-                    'message': 'Позиция должна содержать координаты x и y'
-                }
-
-            # Проверка размера
-            if not isinstance(object_data['size'], (int, float)) or object_data['size'] <= 0:
-                return {
-                    'valid': False,
-                    'message': 'Размер должен быть положительным числом'
-                }
-
+            _validate_object_schema(object_data)
             return {'valid': True, 'message': 'Валидация объекта успешна'}
 
+        except fastjsonschema.JsonSchemaValueException as e:
+            return {'valid': False, 'message': self._schema_error_message(e, object_data)}
+
         except Exception as e:
             return {
                 'valid': False,
                 'message': f'Ошибка при валидации объекта: {str(e)}'
             }
 
+    def _schema_error_message(self, error, object_data) -> str:
+        """Сообщение об ошибке валидации по схеме"""
+        # Ошибка во вложенном поле: path = ['data', <поле>, ...]
+        if len(error.path) > 1:
+            return self.FIELD_ERRORS.get(error.path[1], error.message)
+
+        if error.rule == 'required':
+            field = next(f for f in OBJECT_SCHEMA['required'] if f not in object_data)
+            return f'Отсутствует обязательное поле: {field}'
+
+        return f'Ошибка при валидации объекта: {error.message}'
+
     def check_distance_requirements(self, object_type: str, position: Tuple[float, float, float], 
                                   existing_objects: Dict[int, Dict]) -> Dict:
         """Проверка требований к расстояниям между объектами"""
         try:
+            index = object_snapshot(existing_objects)
+            if not index:
+                return {'valid': True, 'message': 'Distance requirements met'}
+
             min_distances = self.min_distances.get(object_type, {})
             default_distance = self.min_distances['default']
 
-            for obj_id, obj in existing_objects.items():
-                required_distance = min_distances.get(obj['type'], default_distance)
-                actual_distance = self.calculate_distance(position, obj['position'])
+            # Кандидаты — объекты в пределах наибольшего требуемого расстояния
+            radius = max(min_distances.values(), default=default_distance)
+            candidates = index.neighbors(position, max(radius, default_distance))
+
+            required = index.per_type(min_distances, default_distance, candidates)
+            distances = index.distances(position, candidates)
+            violations = np.flatnonzero(distances < required)
 
-                if actual_distance < required_distance:
-                    return {
-                        'valid': False,
-                        'message': f'Too close to {obj["type"]} object (ID: {obj_id}). ' \
-                                 f'Minimum distance: {required_distance}m, ' \
-                                 f'Actual distance: {actual_distance:.1f}m'
-                    }
+            if violations.size:
+                j = violations[0]
+                i = candidates[j]
+                obj_type = index.type_names[index.type_codes[i]]
+                return {
+                    'valid': False,
+                    'message': f'Too close to {obj_type} object (ID: {index.ids[i]}). ' \
+                             f'Minimum distance: {required[j]:g}m, ' \
+                             f'Actual distance: {distances[j]:.1f}m'
+                }
 
             return {'valid': True, 'message': 'Distance requirements met'}
 
@@ -273,7 +378,7 @@ class ObjectValidator:
     def calculate_distance(point1: Tuple[float, float, float], 
                          point2: Tuple[float, float, float]) -> float:
         """Расчет расстояния между двумя точками"""
-        return math.sqrt(sum((a - b) ** 2 for a, b in zip(point1, point2)))
+        return float(np.linalg.norm(position_vector(point1) - position_vector(point2)))
 
 
 class SafetyAnalyzer:
@@ -325,17 +430,25 @@ class SafetyAnalyzer:
         """Проверка зон безопасности"""
         try:
             # Проверяем, не попадает ли объект в чужие зоны безопасности
-            for obj_id, obj in existing_objects.items():
-                if obj['type'] in self.safety_zones:
-                    distance = ObjectValidator.calculate_distance(position, obj['position'])
-                    required_distance = self.safety_zones[obj['type']]
-                    
-                    if distance < required_distance:
-                        return {
-                            'valid': False,
-                            'message': f'Position is within safety zone of {obj["type"]} ' \
-                                     f'(ID: {obj_id}). Required distance: {required_distance}m'
-                        }
+            index = object_snapshot(existing_objects)
+            if not index:
+                return {'valid': True, 'message': 'Safety zones check passed'}
+
+            # Кандидаты — объекты в пределах наибольшей зоны безопасности
+            candidates = index.neighbors(position, max(self.safety_zones.values()))
+
+            required = index.per_type(self.safety_zones, indices=candidates)
+            violations = np.flatnonzero(index.distances(position, candidates) < required)
+
+            if violations.size:
+                j = violations[0]
+                i = candidates[j]
+                obj_type = index.type_names[index.type_codes[i]]
+                return {
+                    'valid': False,
+                    'message': f'Position is within safety zone of {obj_type} ' \
+                             f'(ID: {index.ids[i]}). Required distance: {required[j]:g}m'
+                }
 
             return {'valid': True, 'message': 'Safety zones check passed'}
 
@@ -355,4 +468,20 @@ class SafetyAnalyzer:
                           existing_objects: Dict) -> Dict:
         """Проверка шумового воздействия"""
         # TODO: Реализовать проверку шумового воздействия
-        return {'valid': True, 'message': 'Noise safety check passed'} 
\ No newline at end of file
+        return {'valid': True, 'message': 'Noise safety check passed'}
+
+
+def warm_up():
+    """Прогрев перед первым запросом: декодер PIL, JIT-компиляция ядра
+    уклонов (с cache=True при повторных запусках читается с диска) и
+    скомпилированная схема объекта"""
+    buffer = io.BytesIO()
+    Image.fromarray(np.arange(32 * 32, dtype=np.uint8).reshape(32, 32)).save(buffer, format='PNG')
+    buffer.seek(0)
+
+    terrain_validator = TerrainValidator()
+    height_map = terrain_validator._process_image(buffer)
+    terrain_validator._slope_map(height_map)
+    terrain_validator._slope_map(height_map.astype(np.float32))
+
+    ObjectValidator().validate_object({'type': 'residential', 'position': {'x': 0, 'y': 0}, 'size': 1})